@@ -4,26 +4,38 @@ author: Dan James
 author_url: https://github.com/hello-dan-codes/prompt-scheduler
 funding_url: https://github.com/open-webui
 version: 0.1
-requirements: apscheduler
+requirements: apscheduler, httpx
 license: MIT
 
 This function allows you to schedule prompts to be sent to a model at a specified time. Use cron syntax to set run frequency.
 
 Install:
-    - pip install apscheduler.
+    - pip install apscheduler httpx.
     - Enable function via the "Admin Panel".
     - Create new chat using "Prompt Scheduler" model and send the following command: !help
 """
 
-import requests
+import asyncio
+import functools
+import hashlib
+import httpx
+import json
+import logging
+import re
+import sqlite3
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 from typing import List, Union, Generator, Iterator
 from pydantic import BaseModel
 from utils.misc import get_last_user_message
 
+from sqlalchemy import Column, MetaData, String, Table, Text, create_engine, delete, event, insert, select, text, update
+from sqlalchemy.pool import QueuePool
+
 from open_webui.config import WEBUI_URL
+from open_webui.internal.db import get_db
 from open_webui.models.models import Models
 from open_webui.models.users import Users
 from open_webui.models.chats import ChatForm, Chats
@@ -37,13 +49,310 @@ VERSION = "0.1"
 VERSION_REF = VERSION.replace(".", "")
 VERSION_ID = f"prompt-scheduler-v{VERSION_REF}"
 
+log = logging.getLogger(__name__)
+
+# command arguments. the prompt runs to the last ">" so it may contain ">" itself
+_ADD_RE = re.compile(r"!add\s*<([^>]+)>\s*<([^>]+)>\s*<(.+)>\s*$", re.DOTALL)
+_REMOVE_RE = re.compile(r"!remove\s*<([^>]+)>")
+
+# five cron fields, each "*" or a number. bounds are minute, hour, day of month, month, day of week
+_CRON_RE = re.compile(r"^\s*(\*|\d+)(?:\s+(\*|\d+)){4}\s*$")
+_CRON_BOUNDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+# seconds to wait on the completions endpoint before giving up on a run
+HTTP_TIMEOUT = 300
+
+# status codes worth retrying, and the backoff base in seconds (0.5, 1, 2, 4, 8)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_RETRIES = 5
+RETRY_BACKOFF = 0.5
+# cap on a server's Retry-After, a blocked job also blocks its later fires and coalesced duplicates
+RETRY_MAX_DELAY = 60
+
+# JSON1 functions (and the [#] array append path) are always built in from SQLite 3.38
+SQLITE_JSON1 = sqlite3.sqlite_version_info >= (3, 38)
+
+# blocking DB calls run here so a slow query or SQLite lock never stalls the event loop
+_DB_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix="prompt-scheduler-db")
+
+
+async def _to_thread(func, *args, **kwargs):
+    """ Run a blocking call on the DB executor and await its result. """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_DB_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+
+# shared client so scheduled runs reuse keep-alive connections to the webui
+http_client = httpx.AsyncClient(
+    timeout=HTTP_TIMEOUT,
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+)
+
+engine = create_engine(
+    f"sqlite:///{VERSION_ID}.sqlite",
+    connect_args={"check_same_thread": False},
+    poolclass=QueuePool,
+    pool_size=5,
+)
+
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets job reads run alongside writes, busy_timeout waits on locks instead of failing
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+class _JobState:
+    """ Per-job state kept beside the jobstore, so scheduled jobs only need to persist their id. """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.table = Table(
+            "prompt_scheduler_job_state",
+            MetaData(),
+            Column("job_id", String(191), primary_key=True),
+            Column("user_id", String(191)),
+            Column("model", Text),
+            Column("prompt", Text),
+            Column("chat_id", String(191), nullable=True),
+        )
+        self.table.create(engine, checkfirst=True)
+
+    def get(self, job_id):
+        with self.engine.connect() as conn:
+            row = conn.execute(select(self.table).where(self.table.c.job_id == job_id)).mappings().first()
+        return dict(row) if row else None
+
+    def put(self, job_id, user_id, model, prompt, chat_id=None):
+        with self.engine.begin() as conn:
+            conn.execute(
+                insert(self.table).prefix_with("OR REPLACE"),
+                {"job_id": job_id, "user_id": user_id, "model": model, "prompt": prompt, "chat_id": chat_id},
+            )
+
+    def set_chat_id(self, job_id, chat_id):
+        # UPDATE, not put(), so a run finishing after !remove or !clear can't recreate the row
+        with self.engine.begin() as conn:
+            conn.execute(update(self.table).where(self.table.c.job_id == job_id).values(chat_id=chat_id))
+
+    def delete(self, job_id):
+        with self.engine.begin() as conn:
+            conn.execute(delete(self.table).where(self.table.c.job_id == job_id))
+
+    def clear(self):
+        with self.engine.begin() as conn:
+            conn.execute(delete(self.table))
+
+
+job_state = _JobState(engine)
+
 jobstores = {
-    'default': SQLAlchemyJobStore(url=f"sqlite:///{VERSION_ID}.sqlite")
+    'default': SQLAlchemyJobStore(engine=engine)
 }
 scheduler = AsyncIOScheduler()
 scheduler.configure(jobstores=jobstores)
 scheduler.start()
 
+# seconds a job token is valid for, and how early to mint a replacement
+TOKEN_TTL = 300
+TOKEN_REFRESH_MARGIN = 30
+
+_TOKEN_CACHE: dict[str, tuple[str, float]] = {}
+
+
+def _get_token(user_id):
+    """ Return a cached token for the user, minting a new one when it is close to expiry. """
+    token, expires_at = _TOKEN_CACHE.get(user_id, (None, 0))
+    if time.time() < expires_at - TOKEN_REFRESH_MARGIN:
+        return token
+
+    token = create_token(
+        data={"id": user_id},
+        expires_delta=timedelta(seconds=TOKEN_TTL),
+    )
+    _TOKEN_CACHE[user_id] = (token, time.time() + TOKEN_TTL)
+    return token
+
+
+class _LLMCache:
+    """ In-memory cache of assistant messages keyed on (user, model, prompt), so repeat runs skip the request. """
+
+    def __init__(self, enabled=True, ttl=3600):
+        self.enabled = enabled
+        self.ttl = ttl
+        self._entries: dict[str, tuple[dict, float]] = {}
+
+    @staticmethod
+    def key(user_id, model, prompt):
+        data = json.dumps({"user_id": user_id, "model": model, "prompt": prompt}, sort_keys=True)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, user_id, model, prompt):
+        key = self.key(user_id, model, prompt)
+        message, expires_at = self._entries.get(key, (None, 0))
+        if message is not None and time.time() >= expires_at:
+            del self._entries[key]
+            return None
+        return message
+
+    def set(self, user_id, model, prompt, message):
+        self._entries[self.key(user_id, model, prompt)] = (message, time.time() + self.ttl)
+
+
+# off until pipe() copies in the admin's valves, so a restart can't cache against their settings
+llm_cache = _LLMCache(enabled=False)
+
+
+def _append_chat_messages(chat_id, messages):
+    """ Append messages to a chat transcript in place. Returns False if the chat no longer exists. """
+    with get_db() as db:
+        if db.get_bind().dialect.name == "postgresql":
+            result = db.execute(
+                text(
+                    "UPDATE chat SET chat = jsonb_set("
+                    "chat::jsonb, '{messages}', "
+                    "COALESCE(chat::jsonb -> 'messages', '[]'::jsonb) || CAST(:messages AS jsonb)"
+                    ")::json, updated_at = :updated_at WHERE id = :id"
+                ),
+                {"messages": json.dumps(messages), "updated_at": int(time.time()), "id": chat_id},
+            )
+            db.commit()
+            return result.rowcount > 0
+
+        if db.get_bind().dialect.name == "sqlite" and SQLITE_JSON1:
+            # '$.messages[#]' appends to the end of the array, one path per message
+            paths = ", ".join(f"'$.messages[#]', json(:message_{i})" for i in range(len(messages)))
+            params = {f"message_{i}": json.dumps(message) for i, message in enumerate(messages)}
+            result = db.execute(
+                text(
+                    f"UPDATE chat SET chat = json_insert(json_insert(chat, '$.messages', json('[]')), {paths}), "
+                    "updated_at = :updated_at WHERE id = :id"
+                ),
+                {**params, "updated_at": int(time.time()), "id": chat_id},
+            )
+            db.commit()
+            return result.rowcount > 0
+
+    # no JSON append on this backend, fall back to rewriting the whole transcript
+    chatmodel = Chats.get_chat_by_id(chat_id)
+    if chatmodel is None:
+        return False
+
+    chatmodel.chat['messages'] = chatmodel.chat.get('messages', []) + messages
+    Chats.update_chat_by_id(chat_id, chatmodel.chat)
+    return True
+
+
+def _retry_delay(attempt, response=None):
+    """ Seconds to wait before the next attempt, honouring a Retry-After header in seconds when present. """
+    retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+    if retry_after.isdigit():
+        return min(int(retry_after), RETRY_MAX_DELAY)
+    return RETRY_BACKOFF * 2 ** attempt
+
+
+async def _read_stream(response):
+    """ Assemble the assistant message from a streamed (SSE) chat completion. """
+    role = "assistant"
+    content = []
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+
+        chunk = json.loads(data)
+        if not isinstance(chunk, dict):
+            raise Exception(f"Error: unexpected stream event: {data}")
+
+        # upstream failures arrive as events on a 200 stream
+        error = chunk.get('error') or chunk.get('detail')
+        if error:
+            raise Exception(f"Error: {error}")
+
+        # skip events that carry no completion delta, e.g. sources or usage
+        choices = chunk.get('choices')
+        if not choices:
+            continue
+
+        delta = choices[0].get('delta') or {}
+        role = delta.get('role') or role
+        content.append(delta.get('content') or "")
+
+    message = "".join(content)
+    if not message:
+        raise Exception("Error: empty response from model")
+
+    return {"role": role, "content": message}
+
+
+class PromptCoalescer:
+    """ Share one completion request between duplicate (user, model, prompt) submissions that arrive together. """
+
+    def __init__(self, debounce_ms=200):
+        self.debounce_ms = debounce_ms
+        self._pending: dict[tuple[str, str, str], asyncio.Future] = {}
+        self._tasks = set()
+
+    async def submit(self, user_id, model, prompt, send):
+        """ Await the response for (user_id, model, prompt). The first submitter's send() makes the request for everyone. """
+        # the request goes out with the first submitter's token and tools, so only share it within one user
+        key = (user_id, model, prompt)
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = future
+
+            task = asyncio.create_task(self._flush(key, future, send))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        # shield so one cancelled waiter doesn't cancel the result for the rest
+        return await asyncio.shield(future)
+
+    async def _flush(self, key, future, send):
+        try:
+            await asyncio.sleep(self.debounce_ms / 1000)
+            future.set_result(await send())
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            # a cancelled flush must still release its waiters
+            if not future.done():
+                future.cancel()
+
+            # submissions that arrive while the request is in flight still join it
+            del self._pending[key]
+
+
+prompt_coalescer = PromptCoalescer()
+
+# loaded UserJobs by job id, so the request templates built at add time outlive a single run
+_user_jobs = {}
+
+
+async def _run_job(job_id):
+    """ Scheduler entry point. Rebuilds the UserJob from job_state the first time a job runs in this process. """
+    user_job = _user_jobs.get(job_id)
+    if user_job is None:
+        state = await _to_thread(job_state.get, job_id)
+        if state is None:
+            # without state the job can never run, so drop it rather than firing empty every tick
+            log.warning("Removing scheduled job %s: no job state found", job_id)
+            await _to_thread(scheduler.remove_job, job_id)
+            return
+
+        user_job = await _to_thread(Pipe.UserJob, **state)
+        _user_jobs[job_id] = user_job
+
+    await user_job.run()
+
 
 class Pipe:
     HELP_MESSAGE = """
@@ -68,19 +377,39 @@ class Pipe:
 """
 
     class Valves(BaseModel):
-        pass
+        cache_enabled: bool = True
+        cache_ttl: int = 3600
 
     class UserJob():
-        def __init__(self, job_id=None, user_id=None, model="", prompt=""):
-            self.chat_id = None
+        def __init__(self, job_id=None, user_id=None, model="", prompt="", chat_id=None, model_info=None):
+            self.chat_id = chat_id
             self.user_id = user_id
             self.job_id = job_id
             self.model = model
             self.prompt = prompt
 
-        def run(self):
+            # !add passes the model it already validated, rebuilt jobs look it up here
+            if model_info is None:
+                model_info = Models.get_model_by_id(model)
+            if model_info is None:
+                # the model may have been deleted since the job was added
+                raise ValueError(f"Model not found: {model}")
+
+            self._model_meta = model_info.meta.model_dump()
+            self._model_params = model_info.params.model_dump()
+
+            # a job's model never changes, so build the request once and only add messages and a token per run
+            self._payload_template = {
+                'model': model,
+                'tool_ids': self._model_meta.get('toolIds', None),
+                'stream': True,
+                # TODO enable web_search if user has it enabled on model
+            }
+            self._headers_template = {'Content-Type': 'application/json'}
+
+        async def run(self):
             timestamp = int(time.time())
-            assistant_message = self.send_prompt(self.model, self.prompt)
+            assistant_message = await self.send_prompt(self.model, self.prompt)
 
             new_messages = [
                 {
@@ -99,33 +428,23 @@ class Pipe:
                 }
             ]
 
-            # Check if existing chat exists. If not, create new chat.
+            # Append to the existing chat. If it has been deleted, create new chat.
             if self.chat_id:
-                chat = Chats.get_chat_by_id(self.chat_id)
-                if chat is None:
+                if not await self.existing_chat(new_messages):
                     self.chat_id = None
 
-            # if chat_id is None, create new chat. else, update existing chat
             if self.chat_id is None:
-                self.new_chat(self.model, new_messages)
-
-                # get job scheduler by id. then remove job and readd it with updated chat_id
-                job = scheduler.get_job(self.job_id)
-                job_name = job.name
-                job_trigger = job.trigger
-
-                scheduler.remove_job(self.job_id)
+                await self.new_chat(self.model, new_messages)
+                await _to_thread(job_state.set_chat_id, self.job_id, self.chat_id)
 
-                del job
+        def save(self):
+            job_state.put(self.job_id, self.user_id, self.model, self.prompt, self.chat_id)
 
-                scheduler.add_job(self.run, job_trigger, id=self.job_id, name=job_name, max_instances=1)
-            else:
-                self.existing_chat(new_messages)
-
-        def new_chat(self, model, new_messages):
+        async def new_chat(self, model, new_messages):
             prompt = new_messages[0]['content']
             title = prompt[:50] + "..." if len(prompt) > 50 else prompt
-            response = Chats.insert_new_chat(
+            response = await _to_thread(
+                Chats.insert_new_chat,
                 self.user_id,
                 ChatForm(
                     **{
@@ -139,59 +458,65 @@ class Pipe:
             )
             self.chat_id = response.id
 
-        def existing_chat(self, new_messages):
-            chatmodel = Chats.get_chat_by_id(self.chat_id)
-
-            messages = chatmodel.chat.get('messages', [])
-            messages.append(new_messages[0])
-            messages.append(new_messages[1])
-
-            chatmodel.chat['messages'] = messages
-            Chats.update_chat_by_id(self.chat_id, chatmodel.chat)
-
-        def send_prompt(self, model, prompt):
-            payload = {
-                'model': model,
-                'messages': [{'role': 'user', 'content': prompt}]
-            }
+        async def existing_chat(self, new_messages):
+            return await _to_thread(_append_chat_messages, self.chat_id, new_messages)
+
+        async def send_prompt(self, model, prompt):
+            # only responses from an explicit temperature of 0 are deterministic enough to reuse.
+            # unset means the provider default, which is usually non-zero
+            cacheable = llm_cache.enabled and self._model_params.get('temperature') == 0
+            if cacheable:
+                cached = llm_cache.get(self.user_id, model, prompt)
+                if cached is not None:
+                    return cached
+
+            # jobs firing the same prompt at the same time share one request
+            message = await prompt_coalescer.submit(
+                self.user_id, model, prompt, lambda: self.request_completion(model, prompt)
+            )
 
-            model_info = Models.get_model_by_id(model)
-            model_meta = model_info.meta.model_dump()
-
-            metadata = {
-                "user_id": self.user_id,
-                "chat_id": self.chat_id,
-                "tool_ids": model_meta.get('toolIds', None),
-                "files": None,
-                "features": None,  # TODO enable web_search if user has it enabled on model
-            }
+            if cacheable:
+                llm_cache.set(self.user_id, model, prompt, message)
 
-            payload['tool_ids'] = metadata.get('tool_ids', None)
+            return message
 
-            token = create_token(
-                data={"id": self.user_id},
-                expires_delta=timedelta(seconds=300),
-            )
+        async def request_completion(self, model, prompt):
+            payload = {**self._payload_template, 'messages': [{'role': 'user', 'content': prompt}]}
 
-            headers = {
-                'Authorization': f'Bearer {token}',
-                'Content-Type': 'application/json'
-            }
+            # retry rate limits, upstream errors and dropped connections with exponential backoff
+            for attempt in range(MAX_RETRIES + 1):
+                # fetch per attempt, a slow failed attempt can outlive the previous token
+                headers = {**self._headers_template, 'Authorization': f'Bearer {_get_token(self.user_id)}'}
+                try:
+                    async with http_client.stream("POST", f"{WEBUI_URL}/api/chat/completions", headers=headers, json=payload) as response:
+                        if response.status_code == 200:
+                            return await _read_stream(response)
 
-            response = requests.post(f"{WEBUI_URL}/api/chat/completions", headers=headers, json=payload)
+                        if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                            raise Exception(f"Error: {response.status_code}")
 
-            if response.status_code != 200:
-                raise Exception(f"Error: {response.status_code}")
+                        delay = _retry_delay(attempt, response)
+                except httpx.TransportError:
+                    if attempt == MAX_RETRIES:
+                        raise
 
-            output = response.json()
+                    delay = _retry_delay(attempt)
 
-            return output['choices'][0]['message']
+                await asyncio.sleep(delay)
 
     def __init__(self):
         self.type = "manifold"
         self.id = VERSION_ID
         self.name = "Prompt Scheduler"
-        self.user = Users.get_first_user()
+        self.valves = self.Valves()
+        self.user = None
+        self.handlers = {
+            "!add": self._handle_add,
+            "!remove": self._handle_remove,
+            "!clear": self._handle_clear,
+            "!list": self._handle_list,
+            "!help": self._handle_help,
+        }
 
     def pipes(self) -> List[dict]:
         return [
@@ -199,76 +524,102 @@ class Pipe:
         ]
 
     def get_all_jobs(self, print_run_time=True):
-        output = ""
-        jobs = scheduler.get_jobs()
-        for job in jobs:
-            id = job.id
-            name = job.name
-            next_run_time = job.next_run_time
-            output += f"\nID: {id}\nPrompt: {name}\n"
+        parts = []
+        for job in scheduler.get_jobs():
+            parts.append(f"\nID: {job.id}\nPrompt: {job.name}\n")
 
             if print_run_time:
-                output += f"Next Run Time: {next_run_time}\n"
+                parts.append(f"Next Run Time: {job.next_run_time}\n")
 
-        return output
+        return "".join(parts)
 
-    def pipe(self, body: dict) -> Union[str, Generator, Iterator]:
+    async def pipe(self, body: dict) -> Union[str, Generator, Iterator]:
         messages = body["messages"]
 
+        # scheduled runs have no pipe instance, so share the current valves with the cache
+        llm_cache.enabled = self.valves.cache_enabled
+        llm_cache.ttl = self.valves.cache_ttl
+
         try:
-            return self.process_message(messages)
+            return await self.process_message(messages)
         except Exception as e:
             return f"Error: {e}"
 
-    def process_message(self, messages: list) -> Union[str, Generator, Iterator]:
+    async def process_message(self, messages: list) -> Union[str, Generator, Iterator]:
         user_message = get_last_user_message(messages)
 
         # If messages has no "assistant" content, return help commands at start of chat.
         if len(messages) <= 1:
             return self.HELP_MESSAGE
 
-        if "!add" in user_message:
-            cron, model, prompt = self.input_validation("add", user_message)
-
-            # set job_name to be the first 100 characters of the prompt
-            job_name = prompt[:100] + "... (Truncated)" if len(prompt) > 100 else prompt
-
-            job_id = str(uuid.uuid4())
-            user_job = self.UserJob(job_id, self.user.id, model, prompt)
-
-            job = scheduler.add_job(user_job.run, CronTrigger.from_crontab(cron), id=job_id, name=job_name, max_instances=1)
-            return f"ID: {job.id}\nPrompt: {job.name}\n\nJob added."
-        elif "!remove" in user_message:
-            job_id = self.input_validation("remove", user_message)
-            exists = scheduler.get_job(job_id)
-            if not exists:
-                return "Job not found."
-
-            scheduler.remove_job(job_id)
-            return "Job removed."
-        elif "!clear" in user_message:
-            message = self.get_all_jobs(print_run_time=False)
-            message += "\n\nJobs have been removed."
-            scheduler.remove_all_jobs()
-            return message
-        elif "!list" in user_message:
-            return self.get_all_jobs() or "No jobs found."
-        elif "!help" in user_message:
-            return self.HELP_MESSAGE
+        # the command is the first word, before any <argument>
+        words = (user_message or "").split("<", 1)[0].split()
+        handler = self.handlers.get(words[0]) if words else None
+        if handler is None:
+            return "Invalid syntax. \n\n" + self.HELP_MESSAGE
+
+        return await handler(user_message)
+
+    async def _handle_add(self, user_message):
+        cron, model, prompt, model_info = await _to_thread(self.input_validation, "add", user_message)
+        if self.user is None:
+            self.user = await _to_thread(Users.get_first_user)
 
-        return "Invalid syntax. \n\n" + self.HELP_MESSAGE
+        # set job_name to be the first 100 characters of the prompt
+        job_name = prompt[:100] + "... (Truncated)" if len(prompt) > 100 else prompt
+
+        job_id = str(uuid.uuid4())
+        user_job = self.UserJob(job_id, self.user.id, model, prompt, model_info=model_info)
+        await _to_thread(user_job.save)
+        _user_jobs[job_id] = user_job
+
+        # jobstore calls are SQLite queries too, and APScheduler's asyncio wakeup is thread-safe
+        try:
+            job = await _to_thread(
+                scheduler.add_job, _run_job, CronTrigger.from_crontab(cron), args=[job_id], id=job_id, name=job_name, max_instances=1
+            )
+        except Exception:
+            # state is saved first so the job can't fire without it, so undo it if scheduling fails
+            _user_jobs.pop(job_id, None)
+            await _to_thread(job_state.delete, job_id)
+            raise
+
+        return f"ID: {job.id}\nPrompt: {job.name}\n\nJob added."
+
+    async def _handle_remove(self, user_message):
+        job_id = self.input_validation("remove", user_message)
+        exists = await _to_thread(scheduler.get_job, job_id)
+        if not exists:
+            return "Job not found."
+
+        await _to_thread(scheduler.remove_job, job_id)
+        await _to_thread(job_state.delete, job_id)
+        _user_jobs.pop(job_id, None)
+        return "Job removed."
+
+    async def _handle_clear(self, user_message):
+        message = await _to_thread(self.get_all_jobs, print_run_time=False)
+        message += "\n\nJobs have been removed."
+        await _to_thread(scheduler.remove_all_jobs)
+        await _to_thread(job_state.clear)
+        _user_jobs.clear()
+        return message
+
+    async def _handle_list(self, user_message):
+        return await _to_thread(self.get_all_jobs) or "No jobs found."
+
+    async def _handle_help(self, user_message):
+        return self.HELP_MESSAGE
 
     def input_validation(self, input_type, user_message):
         """ Validate user input for the chosen command. User input should match the command syntax. """
         if input_type == "add":
-            try:
-                _, cron, model, prompt = user_message.split("<", 3)
-                cron = cron.strip().replace(">", "")
-                model = model.strip().replace(">", "")
-                prompt = prompt.strip().replace(">", "")
-            except ValueError:
+            match = _ADD_RE.search(user_message)
+            if not match:
                 raise ValueError("Invalid syntax. \n\n" + self.HELP_MESSAGE)
 
+            cron, model, prompt = (group.strip() for group in match.groups())
+
             # Validate model
             model_info = Models.get_model_by_id(model)
             if not model_info:
@@ -281,22 +632,35 @@ class Pipe:
                 raise ValueError(f"Model not found.\nAvailable models:\n{list_models}")
 
             # Validate cron syntax
-            if len(cron.split(" ")) != 5:
+            if not _CRON_RE.match(cron):
                 raise ValueError("Invalid syntax. \n\n" + self.HELP_MESSAGE)
 
             # validate cron values
-            for value in cron.split(" "):
-                if value == "*":
-                    continue
-                if not value.isnumeric() or (int(value) < 0 or int(value) > 59):
+            for value, (low, high) in zip(cron.split(), _CRON_BOUNDS):
+                if value != "*" and not low <= int(value) <= high:
                     raise ValueError("Invalid syntax. \n\n" + self.HELP_MESSAGE)
 
-            return cron, model, prompt
+            return cron, model, prompt, model_info
         elif input_type == "remove":
-            try:
-                _, job_id = user_message.split("<", 1)
-                job_id = job_id.strip().replace(">", "")
-            except ValueError:
+            match = _REMOVE_RE.search(user_message)
+            if not match:
                 raise ValueError("Invalid syntax. \n\n" + self.HELP_MESSAGE)
 
-            return job_id
+            return match.group(1).strip()
+
+
+def _migrate_pickled_jobs():
+    """ Move jobs stored as pickled UserJob.run methods, from before job_state existed, onto _run_job. """
+    for job in scheduler.get_jobs():
+        # the jobstore saves a bound method as the plain function with the instance prepended to args
+        if not (job.func is Pipe.UserJob.run and job.args and isinstance(job.args[0], Pipe.UserJob)):
+            continue
+
+        user_job = job.args[0]
+
+        job_state.put(job.id, user_job.user_id, user_job.model, user_job.prompt, user_job.chat_id)
+        scheduler.modify_job(job.id, func=_run_job, args=[job.id])
+
+
+# runs once Pipe.UserJob exists to unpickle old jobs, and before the scheduler's first wakeup
+_migrate_pickled_jobs()
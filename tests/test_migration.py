@@ -0,0 +1,74 @@
+import asyncio
+import importlib
+import sys
+import types
+
+import pytest
+from apscheduler.triggers.cron import CronTrigger
+
+
+def _stub_module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+
+
+@pytest.fixture(scope="module")
+def prompt_scheduler(tmp_path_factory):
+    # Open WebUI only exists inside a running webui install, so stand in for the names the function imports
+    _stub_module("utils")
+    _stub_module("utils.misc", get_last_user_message=lambda messages: messages[-1]["content"])
+    _stub_module("open_webui")
+    _stub_module("open_webui.config", WEBUI_URL="http://localhost:8080")
+    _stub_module("open_webui.internal")
+    _stub_module("open_webui.internal.db", get_db=None)
+    _stub_module("open_webui.models")
+    _stub_module("open_webui.models.models", Models=None)
+    _stub_module("open_webui.models.users", Users=None)
+    _stub_module("open_webui.models.chats", ChatForm=None, Chats=None)
+    _stub_module("open_webui.utils")
+    _stub_module("open_webui.utils.auth", create_token=None)
+
+    # the jobstore database is created relative to the working directory on import
+    monkeypatch = pytest.MonkeyPatch()
+    monkeypatch.chdir(tmp_path_factory.mktemp("db"))
+    module = importlib.import_module("prompt_scheduler")
+    yield module
+
+    module.scheduler.shutdown(wait=False)
+    monkeypatch.undo()
+
+
+def test_migrate_pickled_jobs_moves_bound_method_jobs_onto_run_job(prompt_scheduler):
+    # a job as stored before job_state existed: a UserJob.run bound method with only the original attributes
+    user_job = object.__new__(prompt_scheduler.Pipe.UserJob)
+    user_job.__dict__.update(chat_id="chat-1", user_id="user-1", job_id="old", model="gpt4", prompt="Hello world")
+
+    # going through the jobstore round-trips the job through Job.__getstate__ / __setstate__
+    prompt_scheduler.scheduler.add_job(user_job.run, CronTrigger.from_crontab("0 0 1 1 *"), id="old", name="Hello world")
+    stored = prompt_scheduler.scheduler.get_job("old")
+    assert stored.func is prompt_scheduler.Pipe.UserJob.run
+    assert isinstance(stored.args[0], prompt_scheduler.Pipe.UserJob)
+
+    prompt_scheduler._migrate_pickled_jobs()
+
+    migrated = prompt_scheduler.scheduler.get_job("old")
+    assert migrated.func is prompt_scheduler._run_job
+    assert list(migrated.args) == ["old"]
+    assert prompt_scheduler.job_state.get("old") == {
+        "job_id": "old",
+        "user_id": "user-1",
+        "model": "gpt4",
+        "prompt": "Hello world",
+        "chat_id": "chat-1",
+    }
+
+
+def test_run_job_removes_jobs_without_state(prompt_scheduler):
+    prompt_scheduler.scheduler.add_job(
+        prompt_scheduler._run_job, CronTrigger.from_crontab("0 0 1 1 *"), args=["ghost"], id="ghost", name="ghost"
+    )
+
+    asyncio.run(prompt_scheduler._run_job("ghost"))
+
+    assert prompt_scheduler.scheduler.get_job("ghost") is None